@@ -1,7 +1,26 @@
 import telebot
+import ijson
 import json
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+import urllib3
+from urllib3.util.retry import Retry
+import xxhash
+import io
 import os
-import math
+import itertools
+import threading
+import secrets
+import time
+from enum import IntEnum
+from decimal import Decimal
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+from pybloom_live import ScalableBloomFilter
+from pyroaring import BitMap64
+from aiohttp import web
+from telebot.apihelper import ApiTelegramException
 from telebot.types import ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
 
 # ---------------- CONFIGURATION ---------------- #
@@ -11,59 +30,295 @@ if not BOT_TOKEN:
     print("⚠️ Warning: BOT_TOKEN env var not set. Using placeholder.")
     BOT_TOKEN = "YOUR_BOT_TOKEN_HERE"
 
-bot = telebot.TeleBot(BOT_TOKEN)
+# Public HTTPS base URL for webhook mode (e.g. https://bot.example.com); polling is used when unset
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PORT = int(os.getenv("PORT", "8443"))
+# Telegram echoes this back in a header on every webhook call, so forged updates can be rejected
+WEBHOOK_SECRET = secrets.token_urlsafe(32)
+
+# Parallel uploads per split; kept low to stay under Telegram's per-chat rate limit
+UPLOAD_WORKERS = 4
+
+# Filter uploads are parsed and hashed here, off TeleBot's handler threads
+ingest_pool = ThreadPoolExecutor(max_workers=8)
+
+# False-positive rate for '/operation approx' (a hit wrongly removes a main item)
+APPROX_ERROR_RATE = 0.001
+
+# Raised by a streamed upload: malformed JSON or bad UTF-8 in the file, or the download failing mid-read.
+# OSError covers requests' exceptions and socket errors; urllib3 errors can escape raw reads.
+PARSE_ERRORS = (ijson.JSONError, UnicodeDecodeError)
+READ_ERRORS = PARSE_ERRORS + (OSError, urllib3.exceptions.HTTPError)
+# Raised when sending a result back: Telegram rejecting it, or the connection failing
+SEND_ERRORS = (ApiTelegramException, OSError)
+
+# Telegram Bot API file download endpoint (same one TeleBot.download_file uses)
+FILE_URL = "https://api.telegram.org/file/bot{0}/{1}"
+
+# One pooled, keep-alive session shared by every handler thread for API calls and downloads,
+# so TLS handshakes are paid once per connection rather than per request.
+# Retry only covers idempotent requests, so an upload is never sent twice.
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_connections=20, pool_maxsize=20,
+                                      max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504))))
+telebot.apihelper.session = session
+
+# Handler worker threads; downloads and uploads release the GIL, so one chat's parse can overlap another's I/O
+HANDLER_THREADS = 4
+
+bot = telebot.TeleBot(BOT_TOKEN, threaded=True, num_threads=HANDLER_THREADS)
+
+# ---------------- MESSAGES ---------------- #
+
+HELP_TEXT = (
+    "<b>JSON Tool Bot</b>\n\n"
+    "<b>1. Find & Replace</b>\n"
+    "   /replace - Replace text (e.g., domain names) in a file.\n\n"
+    "<b>2. Merge Files (No Duplicates)</b>\n"
+    "   /merge - Combine multiple files into one unique list.\n\n"
+    "<b>3. Subtract Links (Main - Others)</b>\n"
+    "   /operation - Remove processed links from a main file.\n"
+    "   /operation approx - Same, using a Bloom filter for huge filter lists (may drop ~0.1% extra).\n\n"
+    "<b>4. Split JSON</b>\n"
+    "   /split [n] - Split a file into n equal parts.\n\n"
+    "Files can be a JSON list, or .jsonl/.ndjson with one item per line.\n"
+)
+REPLACE_PROMPT = "🔍 <b>Find & Replace</b>\n\nStep 1: Send the text you want to <b>FIND</b>."
+MERGE_PROMPT = "🔗 <b>Merge Mode</b> started.\nUpload files. Duplicates removed.\nType /done when finished."
+OPERATION_PROMPT = "1️⃣ <b>Step 1:</b> Upload the <b>MAIN</b> JSON file."
+INVALID_FILE_TEXT = "❌ Error: File must be a valid JSON List `[...]`."
+DOWNLOAD_FAILED_TEXT = "❌ Error: Could not download the file. Please send it again."
+FILTER_FAILED_TEXT = "❌ Error: Filter could not be added. Please send it again."
+UPLOAD_FAILED_TEXT = "❌ Error: Could not send the result. Please start again."
+
+# One-tap /done keyboard; never mutated after import, so every handler shares it
+DONE_MARKUP = ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
+DONE_MARKUP.add(KeyboardButton("/done"))
 
 # ---------------- STATE MANAGEMENT ---------------- #
-# Modes: 'merge', 'split', 'op_main', 'op_filter'
-# New Modes: 'replace_step1' (waiting for find_text), 'replace_step2' (waiting for new_text), 'replace_ready'
-user_states = {}
+class Mode(IntEnum):
+    REPLACE_STEP1 = 1  # waiting for find_text
+    REPLACE_STEP2 = 2  # waiting for replace_text
+    REPLACE_READY = 3
+    MERGE = 4
+    SPLIT = 5
+    OP_MAIN = 6
+    OP_FILTER = 7
+    BUSY = 8  # /done is writing the result; further files are turned away
+    LOADING = 9  # the file for a one-file step is being processed; further files are turned away
+
+@dataclass(slots=True)
+class BotState:
+    mode: Mode
+    # merge
+    merged_data: dict = field(default_factory=dict)
+    # split
+    split_n: int = 0
+    # replace
+    find_text: str = ""
+    replace_text: str = ""
+    # operation: filter_set is a BitMap64, or a ScalableBloomFilter when approx
+    main_data: list = field(default_factory=list)
+    main_keys: list = field(default_factory=list)
+    filter_set: object = None
+    approx: bool = False
+    # futures for uploads still being ingested (merge files, filters); /done waits on them
+    pending: list = field(default_factory=list)
+    # Guards in-place mutation of this chat's state; held only by this chat's handlers
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+# Sharded by chat id so concurrent chats rarely contend; a shard's lock guards only its dict,
+# never work on a single chat's state.
+STATE_SHARDS = 16
+user_states = [({}, threading.Lock()) for _ in range(STATE_SHARDS)]
 
 # ---------------- HELPER FUNCTIONS ---------------- #
 
-def load_json_content(file_info):
+def iter_json_items(file_info, ndjson=False):
+    # Lazily yields the items of an uploaded JSON list, or returns None if the file isn't one.
+    # A failed download, here or while iterating, raises one of READ_ERRORS.
+    # With ndjson=True the file is one JSON value per line instead, and each line is an item.
+    # The body is streamed from Telegram straight into ijson, so it is never held in memory whole.
+    response = None
     try:
-        downloaded_file = bot.download_file(file_info.file_path)
-        data = json.loads(downloaded_file.decode('utf-8'))
-        return data
-    except Exception as e:
+        response = session.get(FILE_URL.format(BOT_TOKEN, file_info.file_path), stream=True, timeout=60)
+        response.raise_for_status()
+        response.raw.decode_content = True
+        events = ijson.parse(response.raw, multiple_values=ndjson)
+        first = next(events)
+    except READ_ERRORS:
+        if response is not None:
+            response.close()
+        raise
+    if not ndjson and first[1] != 'start_array':
+        response.close()
         return None
+    return _items_from_response(response, itertools.chain([first], events), '' if ndjson else 'item')
+
+def _items_from_response(response, events, prefix):
+    with response:
+        yield from ijson.items(events, prefix)
+
+def _json_default(obj):
+    # ijson parses non-integer numbers as Decimal; write them as the floats json.loads would give
+    if isinstance(obj, Decimal):
+        return float(obj)
+    raise TypeError
+
+def _dumps(obj, option=0):
+    # orjson rejects integers outside 64 bits; the stdlib encoder writes them like json.loads read them
+    try:
+        return orjson.dumps(obj, default=_json_default, option=option)
+    except orjson.JSONEncodeError:
+        return json.dumps(obj, default=_json_default, sort_keys=bool(option & orjson.OPT_SORT_KEYS),
+                          separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+def _key(item):
+    # 64-bit hash of the canonical JSON form; used as the dedup key for every item.
+    # Collisions stay negligible well past a billion items.
+    # Strings (the bulk of link dumps) skip serialization and hash their UTF-8 bytes directly;
+    # the separate seed keeps them from ever sharing a key with a JSON-encoded value.
+    if type(item) is str:
+        return xxhash.xxh3_64_intdigest(item.encode('utf-8'), 1)
+    return xxhash.xxh3_64_intdigest(_dumps(item, orjson.OPT_SORT_KEYS))
+
+def _contains(obj, find):
+    # Allocation-free check for find in any string inside obj (dict keys included)
+    if isinstance(obj, str):
+        return find in obj
+    if isinstance(obj, dict):
+        return any(find in k or _contains(v, find) for k, v in obj.items())
+    if isinstance(obj, list):
+        return any(_contains(v, find) for v in obj)
+    return False
+
+def _subst(obj, find, rep):
+    # Replaces find -> rep in every string inside obj (dict keys included); returns (new_obj, occurrences)
+    if isinstance(obj, str):
+        n = obj.count(find)
+        return (obj.replace(find, rep) if n else obj), n
+    if isinstance(obj, dict):
+        out, total = {}, 0
+        for k, v in obj.items():
+            k, nk = _subst(k, find, rep)
+            v, nv = _subst(v, find, rep)
+            out[k] = v
+            total += nk + nv
+        return out, total
+    if isinstance(obj, list):
+        out, total = [], 0
+        for v in obj:
+            v, n = _subst(v, find, rep)
+            out.append(v)
+            total += n
+        return out, total
+    return obj, 0
+
+def _ingest_filter(message, state):
+    # Runs on ingest_pool: downloads and hashes one filter upload into the chat's filter.
+    # Returns the item count, or None if the file isn't a JSON list.
+    ndjson = (message.document.file_name or "").lower().endswith(('.jsonl', '.ndjson'))
+    data = iter_json_items(bot.get_file(message.document.file_id), ndjson)
+    if data is None:
+        return None
+    if state.approx:
+        keys = list(map(_key, data))
+        with state.lock:
+            for k in keys:
+                state.filter_set.add(k)
+    else:
+        keys = BitMap64(list(map(_key, data)))
+        with state.lock:
+            state.filter_set |= keys
+    return len(keys)
+
+def _report_filter(message, future):
+    try:
+        count = future.result()
+    except PARSE_ERRORS:
+        bot.reply_to(message, INVALID_FILE_TEXT)
+    except READ_ERRORS:
+        bot.reply_to(message, DOWNLOAD_FAILED_TEXT)
+    except Exception:
+        bot.reply_to(message, FILTER_FAILED_TEXT)
+    else:
+        if count is None:
+            bot.reply_to(message, INVALID_FILE_TEXT)
+        else:
+            bot.reply_to(message, f"🗑️ Filter added ({count} items). Upload next or /done.")
+
+def run_webhook():
+    # Updates arrive as HTTP POSTs; process_new_updates hands each one to TeleBot's worker pool,
+    # so the aiohttp loop only parses and enqueues and long uploads never block the next update.
+    async def receive_update(request):
+        if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=403)
+        bot.process_new_updates([telebot.types.Update.de_json(await request.text())])
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post("/webhook", receive_update)
+    bot.remove_webhook()
+    bot.set_webhook(url=f"{WEBHOOK_URL.rstrip('/')}/webhook", secret_token=WEBHOOK_SECRET, drop_pending_updates=True)
+    web.run_app(app, port=WEBHOOK_PORT)
+
+def send_document(chat_id, data, **kwargs):
+    # Sends bytes as a document; on 429 (Telegram allows about one message per second per chat)
+    # waits the retry_after it names and resends, any other error propagates
+    while True:
+        try:
+            return bot.send_document(chat_id, io.BytesIO(data), **kwargs)
+        except ApiTelegramException as e:
+            if e.error_code != 429:
+                raise
+            time.sleep(e.result_json.get('parameters', {}).get('retry_after', 1))
+
+def stream_dump(f, iterable):
+    # Writes a JSON array to a binary file object one element at a time; returns the item count
+    count = 0
+    f.write(b'[')
+    for item in iterable:
+        if count:
+            f.write(b',')
+        f.write(_dumps(item))
+        count += 1
+    f.write(b']')
+    return count
+
+def get_state(chat_id):
+    states, lock = user_states[chat_id % STATE_SHARDS]
+    with lock:
+        return states.get(chat_id)
+
+def set_state(chat_id, state):
+    states, lock = user_states[chat_id % STATE_SHARDS]
+    with lock:
+        states[chat_id] = state
 
 def cleanup_state(chat_id):
-    if chat_id in user_states:
-        del user_states[chat_id]
+    states, lock = user_states[chat_id % STATE_SHARDS]
+    with lock:
+        states.pop(chat_id, None)
 
 # ---------------- HANDLERS ---------------- #
 
 @bot.message_handler(commands=['start', 'help'])
 def send_welcome(message):
-    help_text = (
-        "<b>JSON Tool Bot</b>\n\n"
-        "<b>1. Find & Replace</b>\n"
-        "   /replace - Replace text (e.g., domain names) in a file.\n\n"
-        "<b>2. Merge Files (No Duplicates)</b>\n"
-        "   /merge - Combine multiple files into one unique list.\n\n"
-        "<b>3. Subtract Links (Main - Others)</b>\n"
-        "   /operation - Remove processed links from a main file.\n\n"
-        "<b>4. Split JSON</b>\n"
-        "   /split [n] - Split a file into n equal parts.\n"
-    )
-    bot.reply_to(message, help_text, parse_mode="HTML")
+    bot.reply_to(message, HELP_TEXT, parse_mode="HTML")
 
 # --- 1. REPLACE LOGIC (NEW) ---
 
 @bot.message_handler(commands=['replace'])
 def init_replace(message):
-    user_states[message.chat.id] = {'mode': 'replace_step1'}
-    bot.reply_to(message, "🔍 <b>Find & Replace</b>\n\nStep 1: Send the text you want to <b>FIND</b>.", parse_mode="HTML")
+    set_state(message.chat.id, BotState(Mode.REPLACE_STEP1))
+    bot.reply_to(message, REPLACE_PROMPT, parse_mode="HTML")
 
 # --- 2. MERGE LOGIC ---
 
 @bot.message_handler(commands=['merge'])
 def init_merge(message):
-    user_states[message.chat.id] = {'mode': 'merge', 'merged_data': set()}
-    markup = ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-    markup.add(KeyboardButton("/done"))
-    bot.reply_to(message, "🔗 <b>Merge Mode</b> started.\nUpload files. Duplicates removed.\nType /done when finished.", parse_mode="HTML", reply_markup=markup)
+    set_state(message.chat.id, BotState(Mode.MERGE))
+    bot.reply_to(message, MERGE_PROMPT, parse_mode="HTML", reply_markup=DONE_MARKUP)
 
 # --- 3. SPLIT LOGIC ---
 
@@ -76,195 +331,276 @@ def init_split(message):
             return
         n = int(args[1])
         if n < 1: return
-        user_states[message.chat.id] = {'mode': 'split', 'split_n': n}
+        set_state(message.chat.id, BotState(Mode.SPLIT, split_n=n))
         bot.reply_to(message, f"✂️ Ready to split into {n} files. Upload JSON now.")
-    except:
+    except ValueError:
         bot.reply_to(message, "⚠️ Error.")
 
 # --- 4. SUBTRACT LOGIC ---
 
 @bot.message_handler(commands=['operation'])
 def init_operation(message):
-    user_states[message.chat.id] = {'mode': 'op_main', 'main_data': [], 'filter_set': set()}
-    bot.reply_to(message, "1️⃣ <b>Step 1:</b> Upload the <b>MAIN</b> JSON file.", parse_mode="HTML")
+    approx = message.text.split()[1:2] == ['approx']
+    # Exact mode packs the 64-bit keys into a roaring bitmap (no per-entry PyObject);
+    # approximate mode keeps only a Bloom filter of them, ~2 bytes per item.
+    filter_set = ScalableBloomFilter(initial_capacity=100000, error_rate=APPROX_ERROR_RATE) if approx else BitMap64()
+    set_state(message.chat.id, BotState(Mode.OP_MAIN, filter_set=filter_set, approx=approx))
+    bot.reply_to(message, OPERATION_PROMPT, parse_mode="HTML")
 
 # --- TEXT HANDLER (For Replace Steps) ---
 
 @bot.message_handler(func=lambda message: message.content_type == 'text' and not message.text.startswith('/'))
 def handle_text_inputs(message):
     chat_id = message.chat.id
-    state = user_states.get(chat_id)
+    state = get_state(chat_id)
     
     if not state: 
         return
 
-    # Handling REPLACE input steps
-    if state['mode'] == 'replace_step1':
-        state['find_text'] = message.text
-        state['mode'] = 'replace_step2'
+    # Handling REPLACE input steps; the step is checked and advanced under one lock hold
+    with state.lock:
+        mode = state.mode
+        if mode == Mode.REPLACE_STEP1:
+            state.find_text = message.text
+            state.mode = Mode.REPLACE_STEP2
+        elif mode == Mode.REPLACE_STEP2:
+            state.replace_text = message.text
+            state.mode = Mode.REPLACE_READY
+
+    if mode == Mode.REPLACE_STEP1:
         bot.reply_to(message, f"✅ Finding: <code>{message.text}</code>\n\nStep 2: Send the text to <b>REPLACE IT WITH</b>.", parse_mode="HTML")
         
-    elif state['mode'] == 'replace_step2':
-        state['replace_text'] = message.text
-        state['mode'] = 'replace_ready'
-        find = state['find_text']
-        rep = state['replace_text']
+    elif mode == Mode.REPLACE_STEP2:
+        find = state.find_text
+        rep = state.replace_text
         bot.reply_to(message, f"🔄 Replacing: <code>{find}</code> ➡️ <code>{rep}</code>\n\nStep 3: Upload your JSON file now.", parse_mode="HTML")
 
 # --- GENERIC /DONE HANDLER ---
 
+# FINALIZING MERGE
+def _done_merge(message, state):
+    chat_id = message.chat.id
+    # Turn away new uploads, then let the ones already downloading land; after that nothing
+    # else writes merged_data, so it is serialized without holding the lock
+    with state.lock:
+        state.mode = Mode.BUSY
+    wait(state.pending)
+    merged = state.merged_data
+    if not merged:
+        with state.lock:
+            state.mode = Mode.MERGE
+        bot.reply_to(message, "⚠️ No data.")
+        return
+        
+    bot.send_message(chat_id, f"⚙️ Saving merged file ({len(merged)} unique items)...")
+    
+    buf = io.BytesIO()
+    stream_dump(buf, merged.values())
+    buf.seek(0)
+    bot.send_document(chat_id, buf, caption="✅ Merge Complete", visible_file_name=f"Merged_{len(merged)}_unique.json")
+    cleanup_state(chat_id)
+
+# FINALIZING SUBTRACTION
+def _done_subtract(message, state):
+    chat_id = message.chat.id
+    if not state.main_data: return
+    
+    # Turn away new filters, then let any still being ingested land first
+    with state.lock:
+        state.mode = Mode.BUSY
+    wait(state.pending)
+    failed = [f for f in state.pending if f.exception() is not None]
+    if failed:
+        # Each failure was already reported; subtracting without it would keep items it removes
+        with state.lock:
+            state.pending = [f for f in state.pending if f not in failed]
+            state.mode = Mode.OP_FILTER
+        bot.reply_to(message, f"⚠️ {len(failed)} filter(s) failed to load. Send them again, then /done.")
+        return
+    main_list = state.main_data
+    main_keys = state.main_keys
+    filter_set = state.filter_set
+    
+    buf = io.BytesIO()
+    remaining = stream_dump(buf, (item for item, k in zip(main_list, main_keys) if k not in filter_set))
+    buf.seek(0)
+    bot.send_document(chat_id, buf, caption=f"✅ Done. Remaining: {remaining}", visible_file_name=f"Result_{remaining}_items.json")
+    cleanup_state(chat_id)
+
+_DONE_HANDLERS = {
+    Mode.MERGE: _done_merge,
+    Mode.OP_MAIN: _done_subtract,
+    Mode.OP_FILTER: _done_subtract,
+}
+
 @bot.message_handler(commands=['done'])
 def finalize_action(message):
-    chat_id = message.chat.id
-    state = user_states.get(chat_id)
+    state = get_state(message.chat.id)
 
     if not state: return
 
-    # FINALIZING MERGE
-    if state['mode'] == 'merge':
-        data_set = state['merged_data']
-        if not data_set:
-            bot.reply_to(message, "⚠️ No data.")
-            return
-            
-        bot.send_message(chat_id, f"⚙️ Saving merged file ({len(data_set)} unique items)...")
-        
-        final_list = []
-        for item in data_set:
-            if isinstance(item, str) and item.startswith("JSON_OBJ:"):
-                try:
-                    final_list.append(json.loads(item[9:]))
-                except:
-                    final_list.append(item)
-            else:
-                final_list.append(item)
-        
-        filename = f"Merged_{len(final_list)}_unique.json"
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(final_list, f, indent=2)
-            
-        with open(filename, 'rb') as f:
-            bot.send_document(chat_id, f, caption="✅ Merge Complete")
-        os.remove(filename)
-        cleanup_state(chat_id)
-
-    # FINALIZING SUBTRACTION
-    elif state['mode'] in ['op_main', 'op_filter']:
-        if not state['main_data']: return
-        
-        main_list = state['main_data']
-        filter_set = state['filter_set']
-        
-        final_list = []
-        for item in main_list:
-            check_val = item
-            if isinstance(item, (dict, list)):
-                check_val = json.dumps(item, sort_keys=True)
-            if check_val not in filter_set:
-                final_list.append(item)
-        
-        filename = f"Result_{len(final_list)}_items.json"
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(final_list, f, indent=2)
-        
-        with open(filename, 'rb') as f:
-            bot.send_document(chat_id, f, caption=f"✅ Done. Remaining: {len(final_list)}")
-        os.remove(filename)
-        cleanup_state(chat_id)
+    handler = _DONE_HANDLERS.get(state.mode)
+    if handler:
+        handler(message, state)
 
 # --- FILE HANDLER ---
 
+# >>> MODE: REPLACE <<<
+def _file_replace(message, state, data):
+    chat_id = message.chat.id
+    find_str = state.find_text
+    rep_str = state.replace_text
+    count = 0
+
+    def replaced():
+        nonlocal count
+        for item in data:
+            # Walks objects directly, so links inside them are replaced without a JSON round-trip;
+            # items without a match are passed through as-is instead of being rebuilt
+            if _contains(item, find_str):
+                item, n = _subst(item, find_str, rep_str)
+                count += n
+            yield item
+
+    # Items go from the upload stream to the output buffer one at a time; no result list is built
+    buf = io.BytesIO()
+    stream_dump(buf, replaced())
+
+    try:
+        bot.send_message(chat_id, f"✅ Replaced {count} occurrences.")
+        send_document(chat_id, buf.getvalue(), visible_file_name="Replaced_Output.json")
+    except SEND_ERRORS:
+        bot.send_message(chat_id, UPLOAD_FAILED_TEXT)
+    cleanup_state(chat_id)
+
+# >>> MODE: MERGE <<<
+def _file_merge(message, state, data):
+    merged = state.merged_data
+    # Collect first so a malformed file doesn't leave a partial merge behind
+    fresh = {}
+    for item in data:
+        k = _key(item)
+        if k not in merged:
+            fresh.setdefault(k, item)
+    with state.lock:
+        merged.update(fresh)
+    bot.reply_to(message, f"➕ Added unique items. Total: {len(merged)}")
+
+# >>> MODE: SPLIT <<<
+def _file_split(message, state, data):
+    chat_id = message.chat.id
+    data = list(data)
+    # Never more parts than items, so no part comes out empty
+    n = min(state.split_n, len(data))
+    # Balanced boundaries: the first r parts get one extra item
+    q, r = divmod(len(data), n) if n else (0, 0)
+    offsets = [i*q + min(i, r) for i in range(n + 1)]
+
+    def send_part(i):
+        # Serialized in the worker, so only the parts currently uploading are held as bytes
+        part = _dumps(data[offsets[i] : offsets[i+1]])
+        send_document(chat_id, part, caption=f"Part {i+1}", visible_file_name=f"Part_{i+1}.json")
+
+    # Uploads are independent network round-trips, so overlap them
+    try:
+        with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as pool:
+            list(pool.map(send_part, range(n)))
+    except SEND_ERRORS:
+        bot.send_message(chat_id, UPLOAD_FAILED_TEXT)
+    cleanup_state(chat_id)
+
+# >>> MODE: OP MAIN <<<
+def _file_op_main(message, state, data):
+    # Digests are computed once here so /done only does set lookups
+    main_data = list(data)
+    main_keys = list(map(_key, main_data))
+    with state.lock:
+        state.main_data = main_data
+        state.main_keys = main_keys
+        state.mode = Mode.OP_FILTER
+    bot.reply_to(message, f"✅ Main loaded. Upload filters.", reply_markup=DONE_MARKUP)
+
+# >>> MODE: OP FILTER <<<
+def _queue_filter(message, state):
+    # Called with state.lock held, right after the mode check. The download runs on ingest_pool
+    # too, so the future is in pending before any network wait and /done always waits for it.
+    future = ingest_pool.submit(_ingest_filter, message, state)
+    state.pending.append(future)
+    return future
+
+# Steps that take exactly one file; the first file moves the chat to LOADING before it downloads
+_ONE_FILE_MODES = (Mode.REPLACE_READY, Mode.SPLIT, Mode.OP_MAIN)
+
+_FILE_HANDLERS = {
+    Mode.REPLACE_READY: _file_replace,
+    Mode.MERGE: _file_merge,
+    Mode.SPLIT: _file_split,
+    Mode.OP_MAIN: _file_op_main,
+}
+
 @bot.message_handler(content_types=['document'])
 def handle_files(message):
     chat_id = message.chat.id
-    state = user_states.get(chat_id)
+    state = get_state(chat_id)
     
     if not state:
         bot.reply_to(message, "⚠️ Select a command first.")
         return
 
-    file_info = bot.get_file(message.document.file_id)
-    data = load_json_content(file_info)
+    upload = None
+    with state.lock:
+        mode = state.mode
+        if mode == Mode.MERGE:
+            # Registered before the download starts, so a /done from here on waits for this file
+            upload = Future()
+            state.pending.append(upload)
+        elif mode == Mode.OP_FILTER:
+            future = _queue_filter(message, state)
+        elif mode in _ONE_FILE_MODES:
+            # Checked and advanced in one step, so a second file sent alongside can't take this step too
+            state.mode = Mode.LOADING
+
+    if mode == Mode.BUSY:
+        bot.reply_to(message, "⏳ Still finishing your last /done. Start a new command to continue.")
+        return
+
+    if mode == Mode.LOADING:
+        bot.reply_to(message, "⏳ Still processing your previous file. Send this one after it's done.")
+        return
 
-    if data is None or not isinstance(data, list):
-        bot.reply_to(message, "❌ Error: File must be a valid JSON List `[...]`.")
+    if mode == Mode.OP_FILTER:
+        bot.reply_to(message, "⏳ Filter queued. Upload next or /done.")
+        future.add_done_callback(lambda f: _report_filter(message, f))
         return
 
-    # >>> MODE: REPLACE <<<
-    if state['mode'] == 'replace_ready':
-        find_str = state['find_text']
-        rep_str = state['replace_text']
-        count = 0
-        
-        new_data = []
-        for item in data:
-            if isinstance(item, str):
-                if find_str in item:
-                    item = item.replace(find_str, rep_str)
-                    count += 1
-                new_data.append(item)
-            else:
-                # Handle objects: Convert to string, replace, convert back
-                # This is safer for links inside objects
-                try:
-                    s_item = json.dumps(item)
-                    if find_str in s_item:
-                        s_item = s_item.replace(find_str, rep_str)
-                        item = json.loads(s_item)
-                        count += 1
-                    new_data.append(item)
-                except:
-                    new_data.append(item)
+    handler = _FILE_HANDLERS.get(mode)
+    if not handler:
+        return
 
-        bot.send_message(chat_id, f"✅ Replaced {count} occurrences.")
-        
-        fname = "Replaced_Output.json"
-        with open(fname, 'w', encoding='utf-8') as f:
-            json.dump(new_data, f, indent=2)
-        with open(fname, 'rb') as f:
-            bot.send_document(chat_id, f)
-        os.remove(fname)
-        cleanup_state(chat_id)
-
-    # >>> MODE: MERGE <<<
-    elif state['mode'] == 'merge':
-        initial = len(state['merged_data'])
-        for item in data:
-            if isinstance(item, (dict, list)):
-                state['merged_data'].add("JSON_OBJ:" + json.dumps(item, sort_keys=True))
-            else:
-                state['merged_data'].add(item)
-        bot.reply_to(message, f"➕ Added unique items. Total: {len(state['merged_data'])}")
-
-    # >>> MODE: SPLIT <<<
-    elif state['mode'] == 'split':
-        n = state['split_n']
-        chunk_size = math.ceil(len(data) / n)
-        for i in range(n):
-            chunk = data[i*chunk_size : (i+1)*chunk_size]
-            if not chunk: break
-            fname = f"Part_{i+1}.json"
-            with open(fname, 'w', encoding='utf-8') as f: json.dump(chunk, f, indent=2)
-            with open(fname, 'rb') as f: bot.send_document(chat_id, f, caption=f"Part {i+1}")
-            os.remove(fname)
-        cleanup_state(chat_id)
-
-    # >>> MODE: OP MAIN <<<
-    elif state['mode'] == 'op_main':
-        state['main_data'] = data
-        state['mode'] = 'op_filter'
-        markup = ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-        markup.add(KeyboardButton("/done"))
-        bot.reply_to(message, f"✅ Main loaded. Upload filters.", reply_markup=markup)
-
-    # >>> MODE: OP FILTER <<<
-    elif state['mode'] == 'op_filter':
-        for item in data:
-            if isinstance(item, (dict, list)):
-                state['filter_set'].add(json.dumps(item, sort_keys=True))
-            else:
-                state['filter_set'].add(item)
-        bot.reply_to(message, f"🗑️ Filter added. Upload next or /done.")
+    ndjson = (message.document.file_name or "").lower().endswith(('.jsonl', '.ndjson'))
+    try:
+        data = iter_json_items(bot.get_file(message.document.file_id), ndjson)
+        if data is None:
+            bot.reply_to(message, INVALID_FILE_TEXT)
+            return
+        handler(message, state, data)
+    # Handlers that send results catch SEND_ERRORS themselves, so what reaches here is from the download
+    except PARSE_ERRORS:
+        bot.reply_to(message, INVALID_FILE_TEXT)
+    except READ_ERRORS:
+        bot.reply_to(message, DOWNLOAD_FAILED_TEXT)
+    finally:
+        if upload is not None:
+            upload.set_result(None)
+        # A handler that finished has moved on (or the state is gone); otherwise the step can be retried
+        with state.lock:
+            if state.mode == Mode.LOADING:
+                state.mode = mode
 
 print("Bot is running...")
-bot.infinity_polling()
+if WEBHOOK_URL:
+    run_webhook()
+else:
+    # A webhook left over from an earlier webhook-mode run makes getUpdates fail with 409 Conflict
+    bot.remove_webhook()
+    bot.infinity_polling(skip_pending=True, timeout=60, long_polling_timeout=60)